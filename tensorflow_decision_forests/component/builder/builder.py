@@ -567,27 +567,35 @@ class AbstractDecisionForestBuilder(AbstractBuilder):
     This method should be called on all the trees before any calls to
     "_write_branch".
 
+    The nodes are visited with an explicit stack rather than recursively, so
+    that deep trees do not hit the Python recursion limit.
+
     Args:
       node: The node to write.
     """
 
-    # Possibly register the feature.
-    if isinstance(node, py_tree.node.NonLeafNode):
-      self.check_non_leaf(node)
-      if isinstance(node.condition,
-                    (py_tree.condition.CategoricalIsInCondition,
-                     py_tree.condition.CategoricalSetContainsCondition)):
-        self.observe_feature(node.condition.feature, node.condition.mask)
-      else:
-        for feature in node.condition.features():
-          self.observe_feature(feature)
-    elif isinstance(node, py_tree.node.LeafNode):
-      self.check_leaf(node)
-
-    # Recursive call on the children.
-    if isinstance(node, py_tree.node.NonLeafNode):
-      self._observe_branch(node.neg_child)
-      self._observe_branch(node.pos_child)
+    # Nodes are visited in a Depth First Pre-order, negative child first.
+    nodes = [node]
+    while nodes:
+      node = nodes.pop()
+
+      # Possibly register the feature.
+      if isinstance(node, py_tree.node.NonLeafNode):
+        self.check_non_leaf(node)
+        if isinstance(node.condition,
+                      (py_tree.condition.CategoricalIsInCondition,
+                       py_tree.condition.CategoricalSetContainsCondition)):
+          self.observe_feature(node.condition.feature, node.condition.mask)
+        else:
+          for feature in node.condition.features():
+            self.observe_feature(feature)
+      elif isinstance(node, py_tree.node.LeafNode):
+        self.check_leaf(node)
+
+      # Visit the children.
+      if isinstance(node, py_tree.node.NonLeafNode):
+        nodes.append(node.pos_child)
+        nodes.append(node.neg_child)
 
   def _write_branch(self, node: py_tree.node.AbstractNode):
     """Write of a node and its children to the writer.
@@ -595,22 +603,28 @@ class AbstractDecisionForestBuilder(AbstractBuilder):
     Nodes are written in a Depth First Pre-order traversals (as expected by the
     model format).
 
-    This function is the inverse of inspector_lib._extract_branch.
+    This function is the inverse of inspector_lib._extract_branch. The nodes
+    are visited with an explicit stack rather than recursively, so that deep
+    trees do not hit the Python recursion limit.
 
     Args:
       node: The node to write.
     """
 
-    # Converts the node into a proto node.
-    core_node = py_tree.node.node_to_core_node(node, self.dataspec)
+    nodes = [node]
+    while nodes:
+      node = nodes.pop()
+
+      # Converts the node into a proto node.
+      core_node = py_tree.node.node_to_core_node(node, self.dataspec)
 
-    # Write the node to disk.
-    self._node_writer.write(core_node.SerializeToString())
+      # Write the node to disk.
+      self._node_writer.write(core_node.SerializeToString())
 
-    # Recursive call on the children.
-    if isinstance(node, py_tree.node.NonLeafNode):
-      self._write_branch(node.neg_child)
-      self._write_branch(node.pos_child)
+      # Write the children, negative child first.
+      if isinstance(node, py_tree.node.NonLeafNode):
+        nodes.append(node.pos_child)
+        nodes.append(node.neg_child)
 
   def _finalize_dataspec(self):
     """Finalizes the creation of the dataspec.
@@ -145,17 +145,25 @@ class NonLeafNode(AbstractNode):
       self, conditions: ConditionValueAndDefaultEvaluation):
     """Extracts the condition values and default evaluations."""
 
-    if isinstance(self._condition, condition_lib.NumericalHigherThanCondition):
-      conditions.numerical_higher_than[self._condition.feature.name].append(
-          (self._condition.threshold, self._condition.missing_evaluation))
-
-    if self._pos_child is not None:
-      self._pos_child.collect_condition_parameter_and_default_evaluation(
-          conditions)
-
-    if self._neg_child is not None:
-      self._neg_child.collect_condition_parameter_and_default_evaluation(
-          conditions)
+    # The nodes are visited with an explicit stack rather than recursively, so
+    # that deep trees do not hit the Python recursion limit. Like the recursive
+    # version, the positive child is visited first.
+    nodes = [self]
+    while nodes:
+      node = nodes.pop()
+      if not isinstance(node, NonLeafNode):
+        node.collect_condition_parameter_and_default_evaluation(conditions)
+        continue
+
+      if isinstance(node.condition,
+                    condition_lib.NumericalHigherThanCondition):
+        conditions.numerical_higher_than[node.condition.feature.name].append(
+            (node.condition.threshold, node.condition.missing_evaluation))
+
+      if node.neg_child is not None:
+        nodes.append(node.neg_child)
+      if node.pos_child is not None:
+        nodes.append(node.pos_child)
 
   def __repr__(self):
     text = "NonLeafNode(condition=" + str(self._condition)
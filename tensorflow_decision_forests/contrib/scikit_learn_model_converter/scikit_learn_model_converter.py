@@ -14,13 +14,17 @@
 
 """Utilities for converting Scikit-Learn models into Tensorflow models."""
 
-import contextlib
+import collections
+import concurrent.futures
 import enum
+import errno
 import functools
 import os
 import tempfile
-from typing import Any, Dict, List, Optional, TypeVar, Union
+from typing import Dict, Iterable, Iterator, List, Optional, TypeVar, Union
 
+from absl import logging
+import numpy as np
 from sklearn import base
 from sklearn import dummy
 from sklearn import ensemble
@@ -36,6 +40,14 @@ class TaskType(enum.Enum):
   SINGLE_LABEL_CLASSIFICATION = 3
 
 
+# Maximum number of ensemble trees being converted ahead of the TFDF builder.
+# This is also the number of threads converting them.
+_MAX_PENDING_PYTREES = 4
+
+# Memory-backed filesystem used to hold the intermediate TFDF model, when no
+# intermediate write path is provided.
+_TMPFS_DIRECTORY = "/dev/shm"
+
 ScikitLearnModel = TypeVar("ScikitLearnModel", bound=base.BaseEstimator)
 ScikitLearnTree = TypeVar("ScikitLearnTree", bound=tree.BaseDecisionTree)
 
@@ -66,36 +78,88 @@ def convert(
       process, a TFDF model is written to disk. If intermediate_write_path is
       specified, the TFDF model is written to this directory. Otherwise, a
       temporary directory is created that is immediately removed after this
-      function executes.
+      function executes. The temporary directory is created in memory (in
+      /dev/shm) when possible, and on disk if writing in memory fails.
 
   Returns:
     a keras Model that emulates the provided scikit-learn model.
   """
   if not intermediate_write_path:
-    # No intermediate directory was provided, so this creates one using the
-    # TemporaryDirectory context mananger, which handles teardown.
-    intermediate_write_directory = tempfile.TemporaryDirectory()
-    path = intermediate_write_directory.name
+    # No intermediate directory was provided, so this creates a temporary one
+    # which is removed once the model is loaded.
+    tfdf_model = _build_tfdf_model_in_temporary_directory(sklearn_model)
   else:
-    # Uses the provided write path, and creates a null context manager as a
-    # stand-in for TemporaryDirectory.
-    intermediate_write_directory = contextlib.nullcontext()
-    path = intermediate_write_path
-  with intermediate_write_directory:
-    tfdf_model = _build_tfdf_model(sklearn_model, path)
+    tfdf_model = _build_tfdf_model(sklearn_model, intermediate_write_path)
   # The resultant tfdf model only receives the features that are used
   # to split samples in nodes in the trees as input. But we want to pass the
   # full design matrix as an input to match the scikit-learn API, thus we
   # create another tf.keras.Model with the desired call signature.
   template_input = tf.keras.Input(shape=(sklearn_model.n_features_in_,))
-  # Extracts the indices of the features that are used by the TFDF model.
-  feature_indices = tfdf_model.signatures[
-      "serving_default"].structured_input_signature[1].keys()
+  # Extracts the names of the features that are used by the TFDF model. The
+  # names are the indices of the features in the design matrix.
+  feature_names = list(tfdf_model.signatures["serving_default"]
+                       .structured_input_signature[1].keys())
+  feature_indices = tf.constant([int(name) for name in feature_names],
+                                dtype=tf.int32)
+  # Selects the used features with a single gather, rather than slicing the
+  # input once per feature, and splits them into the per-feature inputs. The
+  # TFDF serving signature only accepts one tensor per feature, but as this is
+  # a functional model the dictionary is only built here, while tracing, and
+  # not on each call.
+  used_features = tf.gather(template_input, feature_indices, axis=1)
   template_output = tfdf_model(
-      {i: template_input[:, int(i)] for i in feature_indices})
+      dict(zip(feature_names, tf.unstack(used_features, axis=1))))
   return tf.keras.Model(inputs=template_input, outputs=template_output)
 
 
+def _get_temporary_directory_root() -> Optional[str]:
+  """Gets the directory in which to create the intermediate TFDF model.
+
+  TFDF builders can only export models to disk, so the model is written to a
+  memory-backed filesystem when one is writable. Otherwise, None is returned
+  and the default temporary directory is used.
+
+  Returns:
+    the parent directory of the temporary directory, or None.
+  """
+  if os.path.isdir(_TMPFS_DIRECTORY) and os.access(_TMPFS_DIRECTORY, os.W_OK):
+    return _TMPFS_DIRECTORY
+  return None
+
+
+def _build_tfdf_model_in_temporary_directory(
+    sklearn_model: ScikitLearnModel) -> tf.keras.Model:
+  """Builds a TFDF model from the given model in a temporary directory.
+
+  The model is first written to a memory-backed filesystem, if any. These are
+  often small (e.g. 64MB in Docker containers), so if the filesystem runs out
+  of space, the model is written again to the default temporary directory.
+
+  Args:
+    sklearn_model: the scikit-learn tree based model to be converted.
+
+  Returns:
+    the TFDF model, loaded in memory.
+  """
+  temporary_directory_root = _get_temporary_directory_root()
+  if temporary_directory_root is not None:
+    try:
+      with tempfile.TemporaryDirectory(dir=temporary_directory_root) as path:
+        return _build_tfdf_model(sklearn_model, path)
+    except (OSError, tf.errors.ResourceExhaustedError) as e:
+      # TensorFlow reports a full filesystem as a ResourceExhaustedError, while
+      # Python file operations raise an OSError with ENOSPC. Other errors are
+      # not related to the filesystem's size, so they are not retried.
+      if isinstance(e, OSError) and e.errno != errno.ENOSPC:
+        raise
+      logging.warning(
+          "Not enough space to write the intermediate TFDF model in %s (%s). "
+          "Writing it to the default temporary directory instead.",
+          temporary_directory_root, e)
+  with tempfile.TemporaryDirectory() as path:
+    return _build_tfdf_model(sklearn_model, path)
+
+
 @functools.singledispatch
 def _build_tfdf_model(
     sklearn_model: ScikitLearnModel,
@@ -126,9 +190,7 @@ def _(sklearn_model: ScikitLearnTree, path: os.PathLike) -> tf.keras.Model:
   """Converts a single scikit-learn classification tree to a TFDF model."""
   objective = tfdf.py_tree.objective.ClassificationObjective(
       label="label",
-      # TF doesnt accept classes that aren't bytes or unicode,
-      # so we convert the classes into strings in case they are not.
-      classes=[str(c) for c in sklearn_model.classes_],
+      classes=_get_sklearn_classes(sklearn_model),
   )
   pytree = convert_sklearn_tree_to_tfdf_pytree(sklearn_model)
   cart_builder = tfdf.builder.CARTBuilder(path=path, objective=objective)
@@ -146,8 +208,9 @@ def _(
   """Converts a forest regression model into a TFDF model."""
   objective = tfdf.py_tree.objective.RegressionObjective(label="label")
   rf_builder = tfdf.builder.RandomForestBuilder(path=path, objective=objective)
-  for single_tree in sklearn_model.estimators_:
-    rf_builder.add_tree(convert_sklearn_tree_to_tfdf_pytree(single_tree))
+  for pytree in _convert_sklearn_trees_to_tfdf_pytrees(
+      sklearn_model.estimators_):
+    rf_builder.add_tree(pytree)
   rf_builder.close()
   return tf.keras.models.load_model(path)
 
@@ -161,11 +224,12 @@ def _(
   """Converts a forest classification model into a TFDF model."""
   objective = tfdf.py_tree.objective.ClassificationObjective(
       label="label",
-      classes=[str(c) for c in sklearn_model.classes_],
+      classes=_get_sklearn_classes(sklearn_model),
   )
   rf_builder = tfdf.builder.RandomForestBuilder(path=path, objective=objective)
-  for single_tree in sklearn_model.estimators_:
-    rf_builder.add_tree(convert_sklearn_tree_to_tfdf_pytree(single_tree))
+  for pytree in _convert_sklearn_trees_to_tfdf_pytrees(
+      sklearn_model.estimators_):
+    rf_builder.add_tree(pytree)
   rf_builder.close()
   return tf.keras.models.load_model(path)
 
@@ -228,47 +292,150 @@ def convert_sklearn_tree_to_tfdf_pytree(
     a TFDF pytree that has the same structure as the scikit-learn tree.
   """
   try:
-    sklearn_tree_data = sklearn_tree.tree_.__getstate__()
+    # These attributes are views on the arrays of the fitted tree, unlike
+    # `__getstate__` which copies the whole tree.
+    sklearn_tree_data = sklearn_tree.tree_
+    left_child = sklearn_tree_data.children_left
+    right_child = sklearn_tree_data.children_right
+    feature = sklearn_tree_data.feature
+    threshold = sklearn_tree_data.threshold
+    target_values = sklearn_tree_data.value
   except AttributeError as e:
     raise ValueError(
         "Scikit-Learn model must be fit to data before converting.") from e
 
-  field_names = sklearn_tree_data["nodes"].dtype.names
   task_type = _get_sklearn_tree_task_type(sklearn_tree)
   if weight and task_type is TaskType.SINGLE_LABEL_CLASSIFICATION:
     raise ValueError("weight should not be passed for classification trees.")
 
-  nodes = []
-  for node_properties, target_value in zip(
-      sklearn_tree_data["nodes"],
-      sklearn_tree_data["values"],
-  ):
-    node = {
-        field_name: field_value
-        for field_name, field_value in zip(field_names, node_properties)
-    }
-    if task_type is TaskType.SCALAR_REGRESSION:
-      scaling_factor = weight if weight else 1.0
-      node["value"] = tfdf.py_tree.value.RegressionValue(target_value[0][0] *
-                                                         scaling_factor)
-    elif task_type is TaskType.SINGLE_LABEL_CLASSIFICATION:
-      # Normalise to probabilities if we have a classification tree.
-      probabilities = list(target_value[0] / target_value[0].sum())
-      node["value"] = tfdf.py_tree.value.ProbabilityValue(probabilities)
-    else:
-      raise ValueError(
-          "Only scalar regression and single-label classification are "
-          "supported.")
-    nodes.append(node)
-
-  root_node = _convert_sklearn_node_to_tfdf_node(
-      # The root node has index zero.
-      node_index=0,
-      nodes=nodes,
+  # Only the leaves hold a value, so no value is built for the split nodes. The
+  # task type is resolved once per tree, so that the leaf loops do not branch
+  # on it.
+  leaf_indices = np.flatnonzero(right_child == -1)
+  if task_type is TaskType.SCALAR_REGRESSION:
+    node_values = _get_sklearn_regression_node_values(
+        target_values,
+        leaf_indices,
+        weight=weight,
+    )
+  elif task_type is TaskType.SINGLE_LABEL_CLASSIFICATION:
+    node_values = _get_sklearn_classification_node_values(
+        target_values,
+        leaf_indices,
+    )
+  else:
+    raise ValueError(
+        "Only scalar regression and single-label classification are "
+        "supported.")
+
+  # The node loop reads the tree structure from Python lists, which is cheaper
+  # than indexing NumPy arrays element by element.
+  root_node = _convert_sklearn_nodes_to_tfdf_root_node(
+      postorder=_get_sklearn_tree_postorder(left_child, right_child),
+      left_child=left_child.tolist(),
+      right_child=right_child.tolist(),
+      feature=feature.tolist(),
+      # TFDF stores numerical thresholds as float32, so they are narrowed once
+      # here instead of node by node when the model is written.
+      threshold=threshold.astype(np.float32, copy=False).tolist(),
+      node_values=node_values,
   )
   return tfdf.py_tree.tree.Tree(root_node)
 
 
+def _get_sklearn_regression_node_values(
+    target_values: np.ndarray,
+    leaf_indices: np.ndarray,
+    weight: Optional[float] = None,
+) -> List[Optional[tfdf.py_tree.value.RegressionValue]]:
+  """Builds the values of the leaves of a scikit-learn regression tree.
+
+  Args:
+    target_values: the values of the nodes in the scikit-learn tree.
+    leaf_indices: the indices of the leaves in the tree.
+    weight: an optional weight to apply to the values of the leaves.
+
+  Returns:
+    the value of each node in the tree, or None for the split nodes.
+  """
+  scaling_factor = weight if weight else 1.0
+  leaf_values = target_values[leaf_indices, 0, 0] * scaling_factor
+  node_values = [None] * len(target_values)
+  for node_index, leaf_value in zip(leaf_indices, leaf_values.tolist()):
+    node_values[node_index] = tfdf.py_tree.value.RegressionValue(leaf_value)
+  return node_values
+
+
+def _get_sklearn_classification_node_values(
+    target_values: np.ndarray,
+    leaf_indices: np.ndarray,
+) -> List[Optional[tfdf.py_tree.value.ProbabilityValue]]:
+  """Builds the values of the leaves of a scikit-learn classification tree.
+
+  Args:
+    target_values: the values of the nodes in the scikit-learn tree.
+    leaf_indices: the indices of the leaves in the tree.
+
+  Returns:
+    the value of each node in the tree, or None for the split nodes.
+  """
+  # Normalise to probabilities if we have a classification tree. Leaves without
+  # any weight (e.g. when all their samples have a zero sample weight) get
+  # all-zero probabilities rather than NaNs.
+  class_weights = target_values[leaf_indices, 0, :]
+  total_weights = class_weights.sum(axis=1, keepdims=True)
+  probabilities = np.divide(
+      class_weights,
+      total_weights,
+      out=np.zeros_like(class_weights, dtype=np.float64),
+      where=total_weights != 0,
+  )
+  node_values = [None] * len(target_values)
+  for node_index, leaf_probabilities in zip(leaf_indices,
+                                            probabilities.tolist()):
+    node_values[node_index] = tfdf.py_tree.value.ProbabilityValue(
+        leaf_probabilities)
+  return node_values
+
+
+def _convert_sklearn_trees_to_tfdf_pytrees(
+    sklearn_trees: Iterable[ScikitLearnTree],
+) -> Iterator[tfdf.py_tree.tree.Tree]:
+  """Converts the trees of a scikit-learn ensemble into TFDF pytrees.
+
+  The trees are independent of each other, so they are converted concurrently.
+  The conversion is mostly pure Python and holds the GIL, so the speedup is
+  limited to the NumPy work of each tree; the thread pool is kept small.
+  The pytrees are yielded in the same order as the scikit-learn trees, and at
+  most `_MAX_PENDING_PYTREES` conversions run ahead of the consumer. Note that
+  the TFDF builders keep every added tree until they are closed, so this bounds
+  the conversions in flight rather than the memory used by the whole ensemble.
+
+  Args:
+    sklearn_trees: the scikit-learn decision trees of the ensemble.
+
+  Yields:
+    the TFDF pytrees, one per scikit-learn tree.
+  """
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=_MAX_PENDING_PYTREES) as executor:
+    pending_pytrees = collections.deque()
+    for sklearn_tree in sklearn_trees:
+      if len(pending_pytrees) >= _MAX_PENDING_PYTREES:
+        yield pending_pytrees.popleft().result()
+      pending_pytrees.append(
+          executor.submit(convert_sklearn_tree_to_tfdf_pytree, sklearn_tree))
+    while pending_pytrees:
+      yield pending_pytrees.popleft().result()
+
+
+def _get_sklearn_classes(sklearn_model: ScikitLearnModel) -> List[str]:
+  """Gets the classes of a scikit-learn classifier as strings."""
+  # TF doesnt accept classes that aren't bytes or unicode,
+  # so we convert the classes into strings in case they are not.
+  return [str(c) for c in sklearn_model.classes_]
+
+
 def _get_sklearn_tree_task_type(sklearn_tree: ScikitLearnTree) -> TaskType:
   """Finds the task type of a scikit learn tree."""
   if hasattr(sklearn_tree, "n_classes_") and sklearn_tree.n_outputs_ == 1:
@@ -279,38 +446,88 @@ def _get_sklearn_tree_task_type(sklearn_tree: ScikitLearnTree) -> TaskType:
     return TaskType.UNKNOWN
 
 
-def _convert_sklearn_node_to_tfdf_node(
-    node_index: int,
-    nodes: List[Dict[str, Any]],
+def _get_sklearn_tree_postorder(
+    left_child: np.ndarray,
+    right_child: np.ndarray,
+) -> List[int]:
+  """Lists the node indices of a scikit-learn tree in postorder.
+
+  In the returned list, every node appears after both of its children.
+
+  Args:
+    left_child: index of the left child of each node, or -1 for leaves.
+    right_child: index of the right child of each node, or -1 for leaves.
+
+  Returns:
+    the indices of the nodes in the tree, children first.
+  """
+  left_child = left_child.tolist()
+  right_child = right_child.tolist()
+  postorder = []
+  # The root node has index zero.
+  stack = [0]
+  while stack:
+    node_index = stack.pop()
+    postorder.append(node_index)
+    if right_child[node_index] != -1:
+      stack.append(left_child[node_index])
+      stack.append(right_child[node_index])
+  # Popping the right child first visits nodes in (node, right, left) order,
+  # the reverse of which is a postorder.
+  postorder.reverse()
+  return postorder
+
+
+def _convert_sklearn_nodes_to_tfdf_root_node(
+    postorder: List[int],
+    left_child: List[int],
+    right_child: List[int],
+    feature: List[int],
+    threshold: List[float],
+    node_values: List[Optional[tfdf.py_tree.value.AbstractValue]],
 ) -> tfdf.py_tree.node.AbstractNode:
-  """Converts a node within a scikit-learn tree into a TFDF node."""
-  if node_index == -1:
-    return None
-
-  node = nodes[node_index]
-  neg_child = _convert_sklearn_node_to_tfdf_node(
-      node_index=node["left_child"],
-      nodes=nodes,
-  )
-  pos_child = _convert_sklearn_node_to_tfdf_node(
-      node_index=node["right_child"],
-      nodes=nodes,
-  )
-  if pos_child:
-    feature = tfdf.py_tree.dataspec.SimpleColumnSpec(
-        name=str(node["feature"]),
-        # In sklearn, all fields must be numerical.
-        type=tfdf.py_tree.dataspec.ColumnType.NUMERICAL,
-        col_idx=node["feature"],
-    )
-    return tfdf.py_tree.node.NonLeafNode(
+  """Converts the nodes of a scikit-learn tree into TFDF nodes.
+
+  The nodes are built bottom-up rather than recursively, so that deep trees
+  do not hit the Python recursion limit.
+
+  Args:
+    postorder: the indices of the nodes, with children before their parent.
+    left_child: index of the left child of each node, or -1 for leaves.
+    right_child: index of the right child of each node, or -1 for leaves.
+    feature: index of the feature used to split each node.
+    threshold: threshold used to split each node.
+    node_values: value of each node. Only the values of the leaves are used.
+
+  Returns:
+    the root node of the TFDF tree.
+  """
+  tfdf_nodes = [None] * len(left_child)
+  # Column specs are immutable, so a single spec is shared by all the nodes
+  # that split on the same feature.
+  column_specs: Dict[int, tfdf.py_tree.dataspec.SimpleColumnSpec] = {}
+  for node_index in postorder:
+    if right_child[node_index] == -1:
+      tfdf_nodes[node_index] = tfdf.py_tree.node.LeafNode(
+          value=node_values[node_index])
+      continue
+    feature_index = feature[node_index]
+    column_spec = column_specs.get(feature_index)
+    if column_spec is None:
+      column_spec = tfdf.py_tree.dataspec.SimpleColumnSpec(
+          name=str(feature_index),
+          # In sklearn, all fields must be numerical.
+          type=tfdf.py_tree.dataspec.ColumnType.NUMERICAL,
+          col_idx=feature_index,
+      )
+      column_specs[feature_index] = column_spec
+    tfdf_nodes[node_index] = tfdf.py_tree.node.NonLeafNode(
         condition=tfdf.py_tree.condition.NumericalHigherThanCondition(
-            feature=feature,
-            threshold=node["threshold"],
+            feature=column_spec,
+            threshold=threshold[node_index],
             missing_evaluation=False,
         ),
-        pos_child=pos_child,
-        neg_child=neg_child,
+        pos_child=tfdf_nodes[right_child[node_index]],
+        neg_child=tfdf_nodes[left_child[node_index]],
     )
-  else:
-    return tfdf.py_tree.node.LeafNode(value=node["value"])
+  return tfdf_nodes[0]
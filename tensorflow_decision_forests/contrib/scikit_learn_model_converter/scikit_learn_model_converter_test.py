@@ -14,6 +14,11 @@
 
 """Tests for scikit_learn_model_converter."""
 
+import errno
+import os
+import sys
+from unittest import mock
+
 from absl.testing import parameterized
 import numpy as np
 from sklearn import datasets
@@ -21,8 +26,10 @@ from sklearn import ensemble
 from sklearn import linear_model
 from sklearn import tree
 import tensorflow as tf
+import tensorflow_decision_forests as tfdf
 
 from tensorflow_decision_forests.contrib import scikit_learn_model_converter
+from tensorflow_decision_forests.contrib.scikit_learn_model_converter import scikit_learn_model_converter as converter_lib
 
 
 class ScikitLearnModelConverterTest(tf.test.TestCase, parameterized.TestCase):
@@ -77,6 +84,22 @@ class ScikitLearnModelConverterTest(tf.test.TestCase, parameterized.TestCase):
     sklearn_labels = sklearn_tree.predict_proba(features).astype(np.float32)
     self.assertAllClose(sklearn_labels, tf_labels, rtol=1e-5)
 
+  def test_convert_reproduces_tree_deeper_than_recursion_limit(self):
+    # Alternating labels along a single feature make scikit-learn grow a chain
+    # of splits, one per example.
+    num_examples = sys.getrecursionlimit() + 100
+    features = np.arange(num_examples, dtype=np.float32).reshape(-1, 1)
+    labels = np.arange(num_examples) % 2
+    sklearn_tree = tree.DecisionTreeRegressor(random_state=42).fit(
+        features,
+        labels,
+    )
+    self.assertGreater(sklearn_tree.get_depth(), sys.getrecursionlimit())
+    tf_tree = scikit_learn_model_converter.convert(sklearn_tree)
+    tf_labels = tf_tree(tf.constant(features)).numpy().ravel()
+    sklearn_labels = sklearn_tree.predict(features).astype(np.float32)
+    self.assertAllClose(sklearn_labels, tf_labels, rtol=1e-5)
+
   def test_convert_raises_when_unrecognised_model_provided(self):
     features, labels = datasets.make_regression(
         n_samples=100,
@@ -142,6 +165,63 @@ class ScikitLearnModelConverterTest(tf.test.TestCase, parameterized.TestCase):
     tfdf_tree = tf.keras.models.load_model(write_path)
     self.assertIsInstance(tfdf_tree, tf.keras.Model)
 
+  def test_convert_retries_on_disk_when_temporary_directory_is_full(self):
+    features, labels = datasets.make_regression(
+        n_samples=100,
+        n_features=10,
+        random_state=42,
+    )
+    sklearn_tree = tree.DecisionTreeRegressor(random_state=42).fit(
+        features,
+        labels,
+    )
+    tmpfs_root = self.create_tempdir().full_path
+    build_tfdf_model = converter_lib._build_tfdf_model
+
+    def build_tfdf_model_without_space_in_tmpfs(sklearn_model, path):
+      if os.path.dirname(path) == tmpfs_root:
+        raise OSError(errno.ENOSPC, "No space left on device")
+      return build_tfdf_model(sklearn_model, path)
+
+    with mock.patch.object(
+        converter_lib,
+        "_get_temporary_directory_root",
+        return_value=tmpfs_root,
+    ), mock.patch.object(
+        converter_lib,
+        "_build_tfdf_model",
+        side_effect=build_tfdf_model_without_space_in_tmpfs,
+    ) as mock_build_tfdf_model:
+      tf_tree = scikit_learn_model_converter.convert(sklearn_tree)
+    self.assertEqual(mock_build_tfdf_model.call_count, 2)
+    tf_features = tf.constant(features, dtype=tf.float32)
+    tf_labels = tf_tree(tf_features).numpy().ravel()
+    sklearn_labels = sklearn_tree.predict(features).astype(np.float32)
+    self.assertAllClose(sklearn_labels, tf_labels, rtol=1e-5)
+
+  def test_convert_does_not_retry_when_temporary_directory_is_not_full(self):
+    features, labels = datasets.make_regression(
+        n_samples=100,
+        n_features=10,
+        random_state=42,
+    )
+    sklearn_tree = tree.DecisionTreeRegressor(random_state=42).fit(
+        features,
+        labels,
+    )
+    with mock.patch.object(
+        converter_lib,
+        "_get_temporary_directory_root",
+        return_value=self.create_tempdir().full_path,
+    ), mock.patch.object(
+        converter_lib,
+        "_build_tfdf_model",
+        side_effect=OSError(errno.EACCES, "Permission denied"),
+    ) as mock_build_tfdf_model:
+      with self.assertRaises(PermissionError):
+        scikit_learn_model_converter.convert(sklearn_tree)
+    self.assertEqual(mock_build_tfdf_model.call_count, 1)
+
   def test_convert_sklearn_tree_to_tfdf_pytree_raises_if_weight_provided_for_classification_tree(
       self):
     features, labels = datasets.make_classification(random_state=42)
@@ -171,6 +251,78 @@ class ScikitLearnModelConverterTest(tf.test.TestCase, parameterized.TestCase):
     with self.assertRaises(ValueError):
       _ = scikit_learn_model_converter.convert(sklearn_model)
 
+  def test_get_sklearn_tree_postorder_lists_children_before_parents(self):
+    features, labels = datasets.make_regression(
+        n_samples=100,
+        n_features=10,
+        random_state=42,
+    )
+    sklearn_tree = tree.DecisionTreeRegressor(random_state=42).fit(
+        features,
+        labels,
+    )
+    left_child = sklearn_tree.tree_.children_left
+    right_child = sklearn_tree.tree_.children_right
+    postorder = converter_lib._get_sklearn_tree_postorder(
+        left_child,
+        right_child,
+    )
+    self.assertCountEqual(postorder, range(sklearn_tree.tree_.node_count))
+    self.assertEqual(postorder[-1], 0)
+    position = {node_index: i for i, node_index in enumerate(postorder)}
+    for node_index in postorder:
+      if right_child[node_index] != -1:
+        self.assertLess(position[left_child[node_index]], position[node_index])
+        self.assertLess(position[right_child[node_index]], position[node_index])
+
+  def test_convert_sklearn_nodes_to_tfdf_root_node_supports_deep_trees(self):
+    # Each split node has a leaf as its left child and the next split node as
+    # its right child, so the tree is deeper than the recursion limit.
+    depth = sys.getrecursionlimit() + 100
+    num_nodes = 2 * depth + 1
+    left_child = np.full(num_nodes, -1)
+    right_child = np.full(num_nodes, -1)
+    split_indices = np.arange(0, 2 * depth, 2)
+    left_child[split_indices] = split_indices + 1
+    right_child[split_indices] = split_indices + 2
+    node_values = converter_lib._get_sklearn_regression_node_values(
+        np.ones((num_nodes, 1, 1)),
+        np.flatnonzero(right_child == -1),
+    )
+    root_node = converter_lib._convert_sklearn_nodes_to_tfdf_root_node(
+        postorder=converter_lib._get_sklearn_tree_postorder(
+            left_child,
+            right_child,
+        ),
+        left_child=left_child.tolist(),
+        right_child=right_child.tolist(),
+        feature=[0] * num_nodes,
+        threshold=[0.5] * num_nodes,
+        node_values=node_values,
+    )
+    self.assertIsInstance(root_node, tfdf.py_tree.node.NonLeafNode)
+    # The pytree is walked iteratively, as it is too deep to recurse over.
+    num_leaves = 0
+    stack = [root_node]
+    while stack:
+      node = stack.pop()
+      if isinstance(node, tfdf.py_tree.node.NonLeafNode):
+        stack.append(node.neg_child)
+        stack.append(node.pos_child)
+      else:
+        num_leaves += 1
+    self.assertEqual(num_leaves, depth + 1)
+
+  def test_get_sklearn_classification_node_values_for_leaves_without_weight(
+      self):
+    target_values = np.array([[[0.0, 0.0]], [[1.0, 3.0]]])
+    node_values = converter_lib._get_sklearn_classification_node_values(
+        target_values,
+        np.array([0, 1]),
+    )
+    self.assertEqual(node_values[0].probability, [0.0, 0.0])
+    self.assertEqual(node_values[1].probability, [0.25, 0.75])
+
 
 if __name__ == "__main__":
   tf.test.main()